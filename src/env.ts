@@ -8,6 +8,11 @@ import * as path from 'path';
 import * as fs from 'fs';
 import * as zephyr from './zephyr';
 
+const workspaceFolderMatch = /\${workspaceFolder:(.+?)}/g;
+const variableMatch = /\$[{(]?(\w+)[})]?/g;
+const macroMatch = /$\([^)]+\)/g;
+const rawUriMatch = /^\w{2,}:\//;
+
 var config = vscode.workspace.getConfiguration('kconfig');
 
 export function getConfig(name: string): any {
@@ -18,6 +23,17 @@ export function setConfig(name: string, value: any, target=vscode.ConfigurationT
 	config.update(name, value, target);
 }
 
+/* Progress and timing output is only useful when debugging the extension: */
+export function isDebugging(): boolean {
+	return !!vscode.debug.activeDebugSession;
+}
+
+export function debugLog(message: string) {
+	if (isDebugging()) {
+		console.log(message);
+	}
+}
+
 export function getRootFile(): vscode.Uri {
 	var root = getConfig('root');
 	if (!root) {
@@ -31,13 +47,20 @@ export function getRootFile(): vscode.Uri {
 	return resolvePath(root);
 }
 
+var rootDir: string | undefined;
+
 /// Root directory of project
 export function getRoot() {
 	if (zephyr.isZephyr && zephyr.zephyrRoot) {
 		return zephyr.zephyrRoot!;
 	}
 
-	return path.dirname(getRootFile().fsPath);
+	// Resolving the root file is fairly expensive, and this is called for every absolute source statement:
+	if (rootDir === undefined) {
+		rootDir = path.dirname(getRootFile().fsPath);
+	}
+
+	return rootDir;
 }
 
 export function isActive(): boolean {
@@ -53,6 +76,8 @@ var env: { [name: string]: string };
 
 export function update() {
 	config = vscode.workspace.getConfiguration('kconfig');
+	rootDir = undefined;
+	resolvedPaths = {};
 	env = <{}>zephyr.getConfig('env') ?? {};
 	let userConf = getConfig('env');
 	Object.keys(userConf).forEach(k => env[k] = userConf[k]);
@@ -96,12 +121,12 @@ export function update() {
 
 export function pathReplace(fileName: string): string {
 	fileName = fileName.replace('${workspaceFolder}', vscode.workspace.workspaceFolders?.[0].uri.fsPath ?? '');
-	fileName = fileName.replace(/\${workspaceFolder:(.+?)}/g, (original, name) => {
+	fileName = fileName.replace(workspaceFolderMatch, (original, name) => {
 		var folder = vscode.workspace.workspaceFolders!.find(folder => folder.name === name);
 		return folder ? folder.uri.fsPath : original;
 	});
 
-	fileName = fileName.replace(/\$[{(]?(\w+)[})]?/g, (original: string, v: string) => {
+	fileName = fileName.replace(variableMatch, (original: string, v: string) => {
 		if (v in env) {
 			return env[v];
 		}
@@ -117,7 +142,7 @@ export function pathReplace(fileName: string): string {
 		return '';
 	});
 
-	return fileName.replace(/$\([^)]+\)/g, '');
+	return fileName.replace(macroMatch, '');
 }
 
 export function getWorkspaceRoot(file: string): string {
@@ -128,13 +153,29 @@ export function getWorkspaceRoot(file: string): string {
 	return vscode.workspace.workspaceFolders?.find(w => fs.existsSync(path.resolve(w.uri.fsPath, file)))?.uri.fsPath ?? vscode.workspace.workspaceFolders?.[0].uri.fsPath ?? path.dirname(file);
 }
 
+/* Source statements resolve the same paths on every scan. Only paths with an explicit base are
+ * cached, as the others depend on which files exist in the workspace: */
+var resolvedPaths: {[path: string]: vscode.Uri} = {};
+
 export function resolvePath(fileName: string, base?: string): vscode.Uri {
 	if (!fileName) {
 		return vscode.Uri.file('');
 	}
 
-	fileName = pathReplace(fileName);
-	if (fileName.match(/^\w{2,}:\//)) { // raw URI
+	if (base) {
+		var key = base + '\n' + fileName;
+		if (!(key in resolvedPaths)) {
+			resolvedPaths[key] = resolveUri(pathReplace(fileName), base);
+		}
+
+		return resolvedPaths[key];
+	}
+
+	return resolveUri(pathReplace(fileName));
+}
+
+function resolveUri(fileName: string, base?: string): vscode.Uri {
+	if (rawUriMatch.test(fileName)) { // raw URI
 		return vscode.Uri.parse(fileName);
 	}
 
@@ -164,6 +205,24 @@ export function readFile(uri: vscode.Uri): string {
 	return '';
 }
 
+var lastDocumentLines: {document: vscode.TextDocument, version: number, lines: string[]} | undefined;
+
+/* Lines of an open document, without joining and re-splitting its full text.
+ * A file that is included several times is parsed once per inclusion, so the lines of the last document are kept: */
+export function documentLines(d: vscode.TextDocument): string[] {
+	if (lastDocumentLines?.document === d && lastDocumentLines.version === d.version) {
+		return lastDocumentLines.lines;
+	}
+
+	var lines = new Array<string>(d.lineCount);
+	for (var i = 0; i < d.lineCount; i++) {
+		lines[i] = d.lineAt(i).text;
+	}
+
+	lastDocumentLines = {document: d, version: d.version, lines: lines};
+	return lines;
+}
+
 export function registerFileProvider(scheme: string, cb: (uri: vscode.Uri) => string) {
 	filemap[scheme] = cb;
 }
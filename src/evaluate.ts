@@ -6,7 +6,7 @@
 import { ConfigValue, EvalContext } from "./kconfig";
 
 
-export enum TokenKind {
+export const enum TokenKind {
 	VAR = "VAR",
 	NUMBER = "NUMBER",
 	STRING = "STRING",
@@ -24,7 +24,7 @@ export enum TokenKind {
 	LESS_EQUAL = "LESS_EQUAL",
 	INVALID = "INVALID",
 }
-export enum Operator {
+export const enum Operator {
 	VAR = "VAR",
 	LITERAL = "LITERAL",
 	NOT = "NOT",
@@ -147,26 +147,31 @@ export class Expression {
 	}
 }
 
+const constantTokens: Token[] = [
+	{ kind: TokenKind.NEQUAL, value: '!=' },
+	{ kind: TokenKind.NOT, value: '!' },
+	{ kind: TokenKind.AND, value: '&&' },
+	{ kind: TokenKind.OR, value: '||' },
+	{ kind: TokenKind.OPEN_PARENTHESIS, value: '(' },
+	{ kind: TokenKind.CLOSING_PARENTHESIS, value: ')' },
+	{ kind: TokenKind.GREATER_EQUAL, value: '>=' },
+	{ kind: TokenKind.LESS_EQUAL, value: '<=' },
+	{ kind: TokenKind.EQUAL, value: '=' },
+	{ kind: TokenKind.GREATER, value: '>' },
+	{ kind: TokenKind.LESS, value: '<' },
+	// { kind: TokenKind.TRISTATE, value: 'y' },
+	// { kind: TokenKind.TRISTATE, value: 'n' },
+	// { kind: TokenKind.TRISTATE, value: 'm' },
+];
+
+// Match all constant tokens in one go. The alternatives are tried in order, so two character tokens must come first:
+const constantTokenMatch = new RegExp('^(?:' + constantTokens.map(t => t.value.replace(/[.*+?^${}()|[\]\\]/g, '\\$&')).join('|') + ')');
+const constantTokenValues: {[value: string]: Token} = {};
+constantTokens.forEach(t => constantTokenValues[t.value] = t);
+
 export function tokenizeExpression(expr: string): Token[] {
 	var tokens: Token[] = [];
 
-	var constant_tokens: Token[] = [
-		{ kind: TokenKind.NEQUAL, value: '!=' },
-		{ kind: TokenKind.NOT, value: '!' },
-		{ kind: TokenKind.AND, value: '&&' },
-		{ kind: TokenKind.OR, value: '||' },
-		{ kind: TokenKind.OPEN_PARENTHESIS, value: '(' },
-		{ kind: TokenKind.CLOSING_PARENTHESIS, value: ')' },
-		{ kind: TokenKind.GREATER_EQUAL, value: '>=' },
-		{ kind: TokenKind.LESS_EQUAL, value: '<=' },
-		{ kind: TokenKind.EQUAL, value: '=' },
-		{ kind: TokenKind.GREATER, value: '>' },
-		{ kind: TokenKind.LESS, value: '<' },
-		// { kind: TokenKind.TRISTATE, value: 'y' },
-		// { kind: TokenKind.TRISTATE, value: 'n' },
-		// { kind: TokenKind.TRISTATE, value: 'm' },
-	];
-
 	while (expr.length > 0) {
 
 		var skippable = expr.match(/^[\s\r\n\\]+/);
@@ -175,10 +180,10 @@ export function tokenizeExpression(expr: string): Token[] {
 			continue;
 		}
 
-		var token = constant_tokens.find(t => expr.startsWith(t.value));
-		if (token) {
-			tokens.push(token);
-			expr = expr.slice(token.value.length);
+		var constant = expr.match(constantTokenMatch);
+		if (constant) {
+			tokens.push(constantTokenValues[constant[0]]);
+			expr = expr.slice(constant[0].length);
 			continue;
 		}
 
@@ -239,15 +244,39 @@ export function tokenizeExpression(expr: string): Token[] {
 	return tokens;
 }
 
-export function makeExpr(tokens: Token[]): Expression {
-	// Tokens in order of precendence:
-	var tokenOrder = [
-		TokenKind.VAR, TokenKind.STRING, TokenKind.NUMBER, TokenKind.TRISTATE,
-		TokenKind.NOT, TokenKind.OR, TokenKind.AND,
-		TokenKind.GREATER_EQUAL, TokenKind.LESS_EQUAL, TokenKind.GREATER, TokenKind.LESS,
-		TokenKind.NEQUAL, TokenKind.EQUAL,
-	];
+// Tokens in order of precendence:
+const tokenOrder = [
+	TokenKind.VAR, TokenKind.STRING, TokenKind.NUMBER, TokenKind.TRISTATE,
+	TokenKind.NOT, TokenKind.OR, TokenKind.AND,
+	TokenKind.GREATER_EQUAL, TokenKind.LESS_EQUAL, TokenKind.GREATER, TokenKind.LESS,
+	TokenKind.NEQUAL, TokenKind.EQUAL,
+];
+
+// Precedence of each token kind, to avoid searching the list for every token:
+const tokenPrecedence: {[kind: string]: number} = {};
+tokenOrder.forEach((kind, i) => tokenPrecedence[kind] = i);
+
+const literalTokens = [TokenKind.STRING, TokenKind.NUMBER, TokenKind.TRISTATE];
+
+function operandCount(operator: Operator): number {
+	switch (operator) {
+		case Operator.VAR: return 0;
+		case Operator.LITERAL: return 0;
+		case Operator.NOT: return 1;
+		case Operator.AND: return 2;
+		case Operator.OR: return 2;
+		case Operator.PARENTHESIS: return 1;
+		case Operator.EQUAL: return 2;
+		case Operator.NEQUAL: return 2;
+		case Operator.GREATER: return 2;
+		case Operator.LESS: return 2;
+		case Operator.GREATER_EQUAL: return 2;
+		case Operator.LESS_EQUAL: return 2;
+		case Operator.UNKNOWN: return 0;
+	}
+}
 
+export function makeExpr(tokens: Token[]): Expression {
 	var depth = 0;
 	var best: { token: Token, index: number, score: number } | undefined;
 
@@ -264,7 +293,7 @@ export function makeExpr(tokens: Token[]): Expression {
 				break;
 			default: {
 				if (depth === 0) {
-					var score = tokenOrder.indexOf(t.kind);
+					var score = tokenPrecedence[t.kind] ?? -1;
 					if (!best || score > best.score) {
 						best = { token: t, index: i, score: score };
 					}
@@ -287,7 +316,7 @@ export function makeExpr(tokens: Token[]): Expression {
 		return new Expression(Operator.VAR, [], best.token);
 	}
 
-	if ([TokenKind.STRING, TokenKind.NUMBER, TokenKind.TRISTATE].includes(best.token.kind)) {
+	if (literalTokens.includes(best.token.kind)) {
 		return new Expression(Operator.LITERAL, [], best.token);
 	}
 
@@ -302,22 +331,7 @@ export function makeExpr(tokens: Token[]): Expression {
 
 	var op = operatorFromToken(best.token);
 
-	if (((operator: Operator) => {
-		switch (operator) {
-			case Operator.VAR: return 0;
-			case Operator.NOT: return 1;
-			case Operator.AND: return 2;
-			case Operator.OR: return 2;
-			case Operator.PARENTHESIS: return 1;
-			case Operator.EQUAL: return 2;
-			case Operator.NEQUAL: return 2;
-			case Operator.GREATER: return 2;
-			case Operator.LESS: return 2;
-			case Operator.GREATER_EQUAL: return 2;
-			case Operator.LESS_EQUAL: return 2;
-			case Operator.UNKNOWN: return 0;
-		}
-	})(op) !== groups.length) {
+	if (operandCount(op) !== groups.length) {
 		throw new ExpressionError('Missing operator', best.token);
 	}
 
@@ -326,9 +340,20 @@ export function makeExpr(tokens: Token[]): Expression {
 	return new Expression(op, operands);
 }
 
+// Dependency strings are resolved over and over during evaluation. Only parse them once:
+const parsedExpressions = new Map<string, Expression>();
+const maxParsedExpressions = 20000;
+
 export function resolveExpression(raw: string, ctx: EvalContext): ConfigValue {
-	var tokens = tokenizeExpression(raw);
-	var expr = makeExpr(tokens);
+	var expr = parsedExpressions.get(raw);
+	if (!expr) {
+		expr = makeExpr(tokenizeExpression(raw));
+		if (parsedExpressions.size >= maxParsedExpressions) {
+			parsedExpressions.clear();
+		}
+
+		parsedExpressions.set(raw, expr);
+	}
 
 	return expr.solve(ctx);
 }
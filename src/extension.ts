@@ -6,13 +6,25 @@
 import * as vscode from 'vscode';
 import * as fuzzy from "fuzzysort";
 import { Operator } from './evaluate';
-import { Config, ConfigOverride, ConfigEntry, Repository, IfScope, Scope, Comment } from "./kconfig";
+import { ConfigOverride, ConfigEntry, Repository, IfScope, Scope, Comment } from "./kconfig";
 import * as kEnv from './env';
 import * as zephyr from './zephyr';
 import { PropFile } from './propfile';
 import * as fs from 'fs';
 import * as path from 'path';
 
+type WorkspaceSymbol = {name: Fuzzysort.Prepared, symbol: vscode.SymbolInformation};
+
+const CONFIG_PREFIX = 'CONFIG_';
+const expressionLineMatch = /(if|depends\s+on|select|default|def_bool|def_tristate|def_int|def_hex|range)/;
+const trailingCommentMatch = /\s*#.*$/;
+const maxWorkspaceSymbols = 200;
+const completionKinds = {
+	'config': vscode.CompletionItemKind.Variable,
+	'menuconfig': vscode.CompletionItemKind.Class,
+	'choice': vscode.CompletionItemKind.Enum,
+};
+
 class KconfigLangHandler
 	implements
 		vscode.DefinitionProvider,
@@ -33,6 +45,10 @@ class KconfigLangHandler
 	temporaryRoot: string | null;
 	rootChangeIgnore = new Array<string>();
 	rescanTimer?: NodeJS.Timeout;
+	kconfigChanges: {[fsPath: string]: {change: vscode.TextDocumentChangeEvent, timer: NodeJS.Timeout}} = {};
+	private cachedWorkspaceSymbols?: {revision: number, symbols: WorkspaceSymbol[]};
+	private cachedCompletions: {[languageId: string]: {revision: number, items: vscode.CompletionItem[]}} = {};
+	private cachedDocumentSymbols: {[uri: string]: {revision: number, version: number, symbols: vscode.DocumentSymbol[]}} = {};
 	constructor() {
 		const sortItems = (item: vscode.CompletionItem, i: number) => {
 			const pad = '0000';
@@ -121,10 +137,15 @@ class KconfigLangHandler
 	registerHandlers(context: vscode.ExtensionContext) {
 		var disposable: vscode.Disposable;
 
-		disposable = vscode.workspace.onDidChangeTextDocument(async e => {
+		disposable = vscode.workspace.onDidChangeTextDocument(e => {
+			// This fires for every document in the workspace, including output channels and dirty state changes:
+			if (e.contentChanges.length === 0) {
+				return;
+			}
+
 			if (e.document.languageId === 'kconfig') {
-				this.repo.onDidChange(e.document.uri, e);
-			} else if (e.document.languageId === 'properties' && e.contentChanges.length > 0) {
+				this.delayedKconfigChange(e);
+			} else if (e.document.languageId === 'properties') {
 				var file = this.propFile(e.document.uri);
 				file.onChange(e);
 			}
@@ -135,6 +156,11 @@ class KconfigLangHandler
 		// Handles git checkouts and similar out-of-editor events
 		var watcher = vscode.workspace.createFileSystemWatcher('**/Kconfig*', true, false, true);
 		watcher.onDidChange(uri => {
+			// Files that aren't part of the parsed tree can't affect it:
+			if (this.repo.filesAt(uri).length === 0) {
+				return;
+			}
+
 			if (!vscode.workspace.textDocuments.some(d => d.uri.fsPath === uri.fsPath)) {
 				this.delayedRescan();
 			}
@@ -165,10 +191,19 @@ class KconfigLangHandler
 			if (d.languageId === 'properties') {
 				var file = this.propFile(d.uri);
 				file.onSave(d);
+			} else if (d.languageId === 'kconfig') {
+				// Don't wait for the debounce, the user expects an up to date tree when saving:
+				this.flushKconfigChange(d.uri);
 			}
 		});
 		context.subscriptions.push(disposable);
 
+		disposable = vscode.workspace.onDidCloseTextDocument(d => {
+			this.flushKconfigChange(d.uri);
+			delete this.cachedDocumentSymbols[d.uri.toString()];
+		});
+		context.subscriptions.push(disposable);
+
 		disposable = vscode.workspace.onDidOpenTextDocument(d => {
 			if (d.languageId === 'properties') {
 				var file;
@@ -195,11 +230,21 @@ class KconfigLangHandler
 				if (e.affectsConfiguration('kconfig.root')) {
 					this.repo.setRoot(kEnv.getRootFile());
 				}
-				this.rescan();
+
+				// Only reparse the Kconfig tree if the change could affect it:
+				if (['kconfig.root', 'kconfig.env', 'kconfig.zephyr', 'kconfig.disable'].some(section => e.affectsConfiguration(section))) {
+					this.rescan();
+				} else if (e.affectsConfiguration('kconfig.conf') || e.affectsConfiguration('kconfig.conf_files')) {
+					this.reloadConf();
+				}
 			}
 		});
 		context.subscriptions.push(disposable);
 
+		// Paths and environment variables may refer to the workspace folders:
+		disposable = vscode.workspace.onDidChangeWorkspaceFolders(() => kEnv.update());
+		context.subscriptions.push(disposable);
+
 		const kconfig = [{ language: 'kconfig', scheme: 'file' }, { language: 'kconfig', scheme: 'kconfig' }];
 		const properties = [{ language: 'properties', scheme: 'file' }];
 		const cFiles = [{ language: 'c', scheme: 'file' }];
@@ -244,15 +289,52 @@ class KconfigLangHandler
 		}, delay);
 	}
 
+	delayedKconfigChange(e: vscode.TextDocumentChangeEvent, delay=300) {
+		if (e.contentChanges.length === 0) {
+			return;
+		}
+
+		// debounce, but keep track of all changed lines so the parser knows which parts are dirty:
+		var change = e;
+		var pending = this.kconfigChanges[e.document.uri.fsPath];
+		if (pending) {
+			clearTimeout(pending.timer);
+			change = { ...e, contentChanges: [...pending.change.contentChanges, ...e.contentChanges] };
+		}
+
+		this.kconfigChanges[e.document.uri.fsPath] = {
+			change: change,
+			timer: setTimeout(() => this.flushKconfigChange(e.document.uri), delay),
+		};
+	}
+
+	flushKconfigChange(uri: vscode.Uri) {
+		var pending = this.kconfigChanges[uri.fsPath];
+		if (pending) {
+			clearTimeout(pending.timer);
+			delete this.kconfigChanges[uri.fsPath];
+			this.repo.onDidChange(uri, pending.change);
+		}
+	}
+
 	rescan() {
-		console.log('Rescan');
+		kEnv.debugLog('Rescan');
 		this.propFiles = {};
 		this.diags.clear();
 		this.repo.reset();
+		// The settings, the west manifest or a module.yml may have changed the list of modules:
+		zephyr.invalidateKconfigRoots();
 
 		return this.doScan();
 	}
 
+	reloadConf() {
+		Object.values(this.propFiles).forEach(file => this.diags.delete(file.uri));
+		this.propFiles = {};
+		this.conf = this.loadConfOptions();
+		this.refreshOpenPropfiles();
+	}
+
 	refreshOpenPropfiles() {
 		vscode.window.visibleTextEditors
 			.filter(e => e.document.languageId === 'properties')
@@ -279,6 +361,8 @@ class KconfigLangHandler
 	}
 
 	deactivate() {
+		Object.values(this.kconfigChanges).forEach(pending => clearTimeout(pending.timer));
+		this.kconfigChanges = {};
 		this.propFiles = {};
 		this.diags.clear();
 		this.repo.reset();
@@ -296,7 +380,7 @@ class KconfigLangHandler
 		this.refreshOpenPropfiles();
 
 		var time_ms = Math.round(hrTime[0] * 1000 + hrTime[1] / 1000000);
-		vscode.window.setStatusBarMessage(`Kconfig: ${Object.keys(this.repo.configs).length} entries, ${time_ms} ms`, 5000);
+		vscode.window.setStatusBarMessage(`Kconfig: ${this.repo.configList.length} entries, ${time_ms} ms`, 5000);
 	}
 
 	loadConfOptions(): ConfigOverride[] {
@@ -305,10 +389,10 @@ class KconfigLangHandler
 		Object.keys(conf).forEach(c => {
 			var e = this.repo.configs[c];
 			if (e) {
-				var value;
-				if (value === true) {
+				var value: string;
+				if (conf[c] === true) {
 					value = 'y';
-				} else if (value === false) {
+				} else if (conf[c] === false) {
 					value = 'n';
 				} else {
 					value = conf[c].toString();
@@ -346,15 +430,19 @@ class KconfigLangHandler
 		return entries;
 	}
 
-	getSymbolName(document: vscode.TextDocument, position: vscode.Position) {
-		var range = document.getWordRangeAtPosition(position);
+	getSymbolName(document: vscode.TextDocument, position: vscode.Position, range=document.getWordRangeAtPosition(position)) {
+		if (!range) {
+			// getText() would return the entire document:
+			return '';
+		}
+
 		var word = document.getText(range);
 		switch (document.languageId) {
 			case 'kconfig':
 				return word;
 			default:
-				if (word.startsWith('CONFIG_')) {
-					return word.slice('CONFIG_'.length);
+				if (word.startsWith(CONFIG_PREFIX)) {
+					return word.slice(CONFIG_PREFIX.length);
 				}
 		}
 		return '';
@@ -381,23 +469,28 @@ class KconfigLangHandler
 			return null;
 		}
 
-		var entry = this.repo.configs[this.getSymbolName(document, position)];
+		// The word range is needed for both the lookup and the hover, only find it once:
+		var range = document.getWordRangeAtPosition(position);
+		var entry = this.repo.configs[this.getSymbolName(document, position, range)];
 		if (!entry) {
 			return null;
 		}
 		var text = new Array<vscode.MarkdownString>();
 		text.push(new vscode.MarkdownString(`${entry.text || entry.name}`));
-		if (entry.type) {
-			var typeLine = new vscode.MarkdownString(`\`${entry.type}\``);
-			if (entry.ranges.length === 1) {
-				typeLine.appendMarkdown(`\t\tRange: \`${entry.ranges[0].min}\`-\`${entry.ranges[0].max}\``);
+		var type = entry.type;
+		if (type) {
+			var typeLine = new vscode.MarkdownString(`\`${type}\``);
+			var ranges = entry.ranges;
+			if (ranges.length === 1) {
+				typeLine.appendMarkdown(`\t\tRange: \`${ranges[0].min}\`-\`${ranges[0].max}\``);
 			}
 			text.push(typeLine);
 		}
-		if (entry.help) {
-			text.push(new vscode.MarkdownString(entry.help));
+		var help = entry.help;
+		if (help) {
+			text.push(new vscode.MarkdownString(help));
 		}
-		return new vscode.Hover(text, document.getWordRangeAtPosition(position));
+		return new vscode.Hover(text, range);
 	}
 
 	provideCompletionItems(document: vscode.TextDocument, position: vscode.Position, token: vscode.CancellationToken, context: vscode.CompletionContext): vscode.ProviderResult<vscode.CompletionItem[] | vscode.CompletionList> {
@@ -405,7 +498,7 @@ class KconfigLangHandler
 		var isProperties = (document.languageId === 'properties');
 		var items: vscode.CompletionItem[];
 
-		if (!isProperties && !line.text.match(/(if|depends\s+on|select|default|def_bool|def_tristate|def_int|def_hex|range)/)) {
+		if (!isProperties && !expressionLineMatch.test(line.text)) {
 			if (line.firstNonWhitespaceCharacterIndex > 0) {
 				return this.propertyCompletions;
 			}
@@ -414,26 +507,32 @@ class KconfigLangHandler
 		}
 
 		if (isProperties) {
-			var lineRange = new vscode.Range(position.line, 0, position.line, 999999);
-			var lineText = document.getText(lineRange);
-			var replaceText = lineText.replace(/\s*#.*$/, '');
+			var replaceText = line.text.replace(trailingCommentMatch, '');
 		}
 
-		const kinds = {
-			'config': vscode.CompletionItemKind.Variable,
-			'menuconfig': vscode.CompletionItemKind.Class,
-			'choice': vscode.CompletionItemKind.Enum,
-		};
+		var cached = this.cachedCompletions[document.languageId];
+		if (cached?.revision !== this.repo.revision) {
+			cached = {revision: this.repo.revision, items: this.configCompletions(isProperties)};
+			this.cachedCompletions[document.languageId] = cached;
+		}
+
+		items = cached.items;
+
+		if (isProperties) {
+			var range = replaceText!.length > 0 ? new vscode.Range(position.line, 0, position.line, replaceText!.length) : undefined;
+			items.forEach(item => item.range = range);
+		}
+
+		return items;
+	}
 
-		items = this.repo.configList.map(e => {
-			var item = new vscode.CompletionItem(isProperties ? `CONFIG_${e.name}` : e.name, (e.kind ? kinds[e.kind] : vscode.CompletionItemKind.Text));
+	/* The config completions only depend on the parsed tree, so they're built once per repository revision: */
+	private configCompletions(isProperties: boolean): vscode.CompletionItem[] {
+		var items = this.repo.configList.map(e => {
+			var item = new vscode.CompletionItem(isProperties ? CONFIG_PREFIX + e.name : e.name, (e.kind ? completionKinds[e.kind] : vscode.CompletionItemKind.Text));
 			item.sortText = e.name;
 			item.detail = e.text;
 			if (isProperties) {
-				if (replaceText.length > 0) {
-					item.range = new vscode.Range(position.line, 0, position.line, replaceText.length);
-				}
-
 				item.insertText = new vscode.SnippetString(`${item.label}=`);
 				switch (e.type) {
 					case 'bool':
@@ -486,20 +585,23 @@ class KconfigLangHandler
 			return item;
 		}
 		var doc = new vscode.MarkdownString(`\`${e.type}\``);
-		if (e.ranges.length === 1) {
-			doc.appendMarkdown(`\t\tRange: \`${e.ranges[0].min}\`-\`${e.ranges[0].max}\``);
+		var ranges = e.ranges;
+		if (ranges.length === 1) {
+			doc.appendMarkdown(`\t\tRange: \`${ranges[0].min}\`-\`${ranges[0].max}\``);
 		}
-		if (e.help) {
+		var help = e.help;
+		if (help) {
 			doc.appendText('\n\n');
-			doc.appendMarkdown(e.help);
+			doc.appendMarkdown(help);
 		}
-		if (e.defaults.length > 0) {
-			if (e.defaults.length > 1) {
+		var defaults = e.defaults;
+		if (defaults.length > 0) {
+			if (defaults.length > 1) {
 				doc.appendMarkdown('\n\n### Defaults:\n');
 			} else {
 				doc.appendMarkdown('\n\n**Default:** ');
 			}
-			e.defaults.forEach(dflt => {
+			defaults.forEach(dflt => {
 				doc.appendMarkdown(`\`${dflt.value}\``);
 				if (dflt.condition) {
 					doc.appendMarkdown(` if \`${dflt.condition}\``);
@@ -512,7 +614,7 @@ class KconfigLangHandler
 	}
 
 	provideDocumentLinks(document: vscode.TextDocument, token: vscode.CancellationToken): vscode.DocumentLink[] {
-		var file = this.repo.files.find(f => f.uri.fsPath === document.uri.fsPath);
+		var file = this.repo.filesAt(document.uri)[0];
 		return file?.links ?? [];
 	}
 
@@ -521,14 +623,24 @@ class KconfigLangHandler
 		context: vscode.ReferenceContext,
 		token: vscode.CancellationToken): vscode.ProviderResult<vscode.Location[]> {
 		var entry = this.repo.configs[this.getSymbolName(document, position)];
-		if (!entry || !entry.type || !['bool', 'tristate'].includes(entry.type)) {
+		if (!entry || (entry.type !== 'bool' && entry.type !== 'tristate')) {
 			return null;
 		}
-		return this.repo.configList
-			.filter(config => (
-				config.allSelects(entry.name).length > 0 ||
-				config.hasDependency(entry!.name)))
-			.map(config => config.entries[0].loc); // TODO: return the entries instead?
+
+		var locations = new Array<vscode.Location>();
+		var configs = this.repo.configList;
+		for (var i = 0; i < configs.length; i++) {
+			// Checking the dependencies of every config is slow, give up as soon as the request is stale:
+			if (token.isCancellationRequested) {
+				return null;
+			}
+
+			if (configs[i].hasSelect(entry.name) || configs[i].hasDependency(entry.name)) {
+				locations.push(configs[i].entries[0].loc); // TODO: return the entries instead?
+			}
+		}
+
+		return locations;
 	}
 
 	provideCodeActions(document: vscode.TextDocument,
@@ -542,21 +654,26 @@ class KconfigLangHandler
 	}
 
 	provideDocumentSymbols(document: vscode.TextDocument, token: vscode.CancellationToken): vscode.ProviderResult<vscode.DocumentSymbol[]> {
+		// The outline is requested repeatedly for the same document, only rebuild it when the document or the tree changes:
+		var uri = document.uri.toString();
+		var cached = this.cachedDocumentSymbols[uri];
+		if (cached?.revision !== this.repo.revision || cached.version !== document.version) {
+			cached = {revision: this.repo.revision, version: document.version, symbols: this.documentSymbols(document)};
+			this.cachedDocumentSymbols[uri] = cached;
+		}
+
+		return cached.symbols;
+	}
+
+	private documentSymbols(document: vscode.TextDocument): vscode.DocumentSymbol[] {
 		if (document.languageId === 'properties') {
-			return this.propFile(document.uri)
-				.overrides.filter(o => o.line !== undefined)
-				.map(
-					o =>
-						new vscode.DocumentSymbol(
-							o.config.name,
-							o.config.text ?? "",
-							o.config.symbolKind(),
-							new vscode.Range(o.line!, 0, o.line!, 99999),
-							new vscode.Range(o.line!, 0, o.line!, 99999)
-						)
-				);
-		}
-		var file = this.repo.files.find(f => f.uri.fsPath === document.uri.fsPath);
+			// Only list the entries from this file, not the ones inherited from the base configuration:
+			return this.propFile(document.uri).conf.map(o => {
+				var range = new vscode.Range(o.line!, 0, o.line!, 99999);
+				return new vscode.DocumentSymbol(o.config.name, o.config.text ?? "", o.config.symbolKind(), range, range);
+			});
+		}
+		var file = this.repo.filesAt(document.uri)[0];
 		if (!file) {
 			return [];
 		}
@@ -591,7 +708,8 @@ class KconfigLangHandler
 					prev[prev.length - 1].range = prev[prev.length - 1].range.union(curr.range);
 					return prev;
 				}
-				return [...prev, curr];
+				prev.push(curr);
+				return prev;
 			}, new Array<vscode.DocumentSymbol>());
 
 			return symbol;
@@ -600,21 +718,35 @@ class KconfigLangHandler
 		return addScope(file.scope).children;
 	}
 
+	private get workspaceSymbols(): WorkspaceSymbol[] {
+		// The symbols only change when the repository does, build them once per revision:
+		if (this.cachedWorkspaceSymbols?.revision !== this.repo.revision) {
+			this.cachedWorkspaceSymbols = {
+				revision: this.repo.revision,
+				symbols: this.repo.configList.filter(e => e.entries.length > 0).map(e => ({
+					name: fuzzy.prepare(e.name),
+					symbol: new vscode.SymbolInformation(
+						CONFIG_PREFIX + e.name,
+						vscode.SymbolKind.Property,
+						e.text ?? '',
+						e.entries[0].loc),
+				})),
+			};
+		}
+
+		return this.cachedWorkspaceSymbols.symbols;
+	}
+
 	provideWorkspaceSymbols(query: string, token: vscode.CancellationToken): vscode.ProviderResult<vscode.SymbolInformation[]> {
-		var entries: Config[];
-		query = query?.replace(/^(CONFIG_)?/, '');
+		if (query?.startsWith(CONFIG_PREFIX)) {
+			query = query.slice(CONFIG_PREFIX.length);
+		}
 
 		if (query) {
-			entries = fuzzy.go(query, this.repo.configList, { key: 'name' }).map(result => result.obj);
-		} else {
-			entries = this.repo.configList;
+			return fuzzy.go(query, this.workspaceSymbols, { key: 'name', limit: maxWorkspaceSymbols }).map(result => result.obj.symbol);
 		}
 
-		return entries.map(e => new vscode.SymbolInformation(
-			`CONFIG_${e.name}`,
-			vscode.SymbolKind.Property,
-			e.text ?? '',
-			e.entries[0].loc));
+		return this.workspaceSymbols.slice(0, maxWorkspaceSymbols).map(s => s.symbol);
 	}
 
 }
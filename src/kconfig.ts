@@ -6,6 +6,7 @@
 import * as vscode from 'vscode';
 import { resolveExpression, createExpression, Expression } from './evaluate';
 import { ParsedFile } from './parse';
+import * as kEnv from './env';
 
 export type ConfigValue = string | number | boolean;
 export type ConfigValueRange = { max: string, min: string, condition?: Expression };
@@ -16,26 +17,48 @@ export type ConfigDefault = {value: string, condition?: Expression};
 export type ConfigSelect = {name: string, condition?: Expression};
 export type LineRange = {start: number, end: number};
 
+const hexValueMatch = /^0x[a-fA-F\d]+$/;
+const intValueMatch = /^\d+$/;
+const stringValueMatch = /^"[^"]*"/;
+const numberSymbolMatch = /^\s*(0x[\da-fA-F]+|[\-+]?\d+)\s*$/;
+const tristateSymbolMatch = /^\s*[ynm]\s*$/;
+
 export class EvalContext {
 	repo: Repository;
 	overrides: ConfigOverride[];
 	evaluated: {[name: string]: ConfigValue};
+	defaults: {[name: string]: ConfigValue | undefined};
+	chosen: Map<ChoiceEntry, Config | undefined>;
+	private overrideIndex: {[name: string]: ConfigOverride};
 
 	constructor(repo: Repository, overrides: ConfigOverride[]) {
 		this.repo = repo;
 		this.overrides = overrides;
 		this.evaluated = {};
+		this.defaults = {};
+		this.chosen = new Map();
+		this.overrideIndex = {};
+		overrides.forEach(o => {
+			if (!(o.config.name in this.overrideIndex)) {
+				this.overrideIndex[o.config.name] = o;
+			}
+		});
 	}
 
-	/* Cache results: */
+	/* First override of the given config, if any: */
+	override(name: string): ConfigOverride | undefined {
+		return this.overrideIndex[name];
+	}
 
-	register(c: Config | Scope, value: ConfigValue): ConfigValue {
-		this.evaluated[(c instanceof Config) ? c.name : c.id] = value;
+	/* Cache results, keyed by config name or scope id: */
+
+	register(key: string, value: ConfigValue): ConfigValue {
+		this.evaluated[key] = value;
 		return value;
 	}
 
-	resolve(c: Config | Scope): ConfigValue | undefined {
-		return this.evaluated[(c instanceof Config) ? c.name : c.id];
+	resolve(key: string): ConfigValue | undefined {
+		return this.evaluated[key];
 	}
 }
 
@@ -49,6 +72,7 @@ export class Comment {
 		this.text = text;
 		this.file = file;
 		this.line = line;
+		this.visible = undefined;
 	}
 }
 
@@ -104,13 +128,13 @@ export abstract class Scope {
 	}
 
 	evaluate(ctx: EvalContext): boolean {
-		var result = ctx.resolve(this);
+		var result = ctx.resolve(this.id);
 		if (result !== undefined) {
 			return !!result;
 		}
 
 		result = this.resolve(ctx) && (this.parent?.evaluate(ctx) ?? true);
-		ctx.register(this, result);
+		ctx.register(this.id, result);
 		return result;
 	}
 
@@ -143,6 +167,7 @@ export class MenuScope extends Scope {
 	constructor(prompt: string, repo: Repository, line: number, file: ParsedFile, parent: Scope) {
 		super('menu', prompt, repo, line, file, vscode.SymbolKind.Class, parent);
 		this.dependencies = [];
+		this.visible = undefined;
 		this.parent = parent;
 	}
 
@@ -201,6 +226,7 @@ export class ConfigEntry {
 	selects: ConfigSelect[];
 	implys: ConfigSelect[];
 	defaults: ConfigDefault[];
+	private cachedLoc?: vscode.Location;
 
 	constructor(config: Config, line: number, file: ParsedFile, scope: Scope) {
 		this.config = config;
@@ -213,6 +239,11 @@ export class ConfigEntry {
 		this.implys = [];
 		this.defaults = [];
 		this.prompt = false;
+		// Assign the optional properties up front, so all entries share the same object shape:
+		this.help = undefined;
+		this.type = undefined;
+		this.text = undefined;
+		this.cachedLoc = undefined;
 
 		if (scope) {
 			scope.children.push(this);
@@ -230,10 +261,15 @@ export class ConfigEntry {
 		}
 
 		this.lines.end = lineNumber;
+		this.cachedLoc = undefined;
 	}
 
 	get loc(): vscode.Location {
-		return new vscode.Location(this.file.uri, new vscode.Range(this.lines.start, 0, this.lines.end, 99999));
+		if (!this.cachedLoc) {
+			this.cachedLoc = new vscode.Location(this.file.uri, new vscode.Range(this.lines.start, 0, this.lines.end, 99999));
+		}
+
+		return this.cachedLoc;
 	}
 
 	isActive(ctx: EvalContext): boolean {
@@ -246,24 +282,48 @@ export class Config {
 	kind: ConfigKind;
 	entries: ConfigEntry[];
 	readonly repo: Repository;
+	private cacheRevision: number;
+	private cachedMainEntry?: ConfigEntry;
+	private cachedType?: ConfigValueType;
+	private cachedHelp?: string;
 
 	constructor(name: string, kind: ConfigKind, repo: Repository) {
 		this.name = name;
 		this.kind = kind;
 		this.repo = repo;
 		this.entries = [];
+		this.cacheRevision = -1;
+		this.cachedMainEntry = undefined;
+		this.cachedType = undefined;
+		this.cachedHelp = undefined;
+	}
+
+	/* Derived properties only change when the repository is reparsed: */
+	private refreshCache() {
+		if (this.cacheRevision !== this.repo.revision) {
+			this.cacheRevision = this.repo.revision;
+			this.cachedMainEntry = this.entries.find(e => e.text);
+			this.cachedType = this.entries.find(e => e.type)?.type;
+			this.cachedHelp = undefined;
+		}
 	}
 
 	get type(): ConfigValueType | undefined {
-		return this.entries.find(e => e.type)?.type;
+		this.refreshCache();
+		return this.cachedType;
 	}
 
 	get help(): string {
-		return this.entries.filter(e => e.help).map(e => e.help).join('\n\n');
+		this.refreshCache();
+		if (this.cachedHelp === undefined) {
+			this.cachedHelp = this.entries.filter(e => e.help).map(e => e.help).join('\n\n');
+		}
+
+		return this.cachedHelp;
 	}
 
 	get text(): string | undefined {
-		return this.entries.find(e => e.text)?.text;
+		return this.mainEntry?.text;
 	}
 
 	get defaults(): ConfigDefault[] {
@@ -285,7 +345,8 @@ export class Config {
 	}
 
 	get mainEntry(): ConfigEntry | undefined {
-		return this.entries.find(e => e.text);
+		this.refreshCache();
+		return this.cachedMainEntry;
 	}
 
 	get dependencies(): string[] {
@@ -309,7 +370,7 @@ export class Config {
 			);
 			configs.push(
 				...e.implys
-					.filter(s => (s.name === name) && !ctx.overrides.some(o => o.config.name === name) && (!s.condition || s.condition.solve(ctx)))
+					.filter(s => (s.name === name) && !ctx.override(name) && (!s.condition || s.condition.solve(ctx)))
 					.map(s => ctx.repo.configs[s.name])
 					.filter(c => c !== undefined)
 			);
@@ -328,16 +389,19 @@ export class Config {
 		return selects;
 	}
 
+	hasSelect(name: string) {
+		return this.entries.some(e => e.selects.some(s => s.name === name));
+	}
+
 	hasDependency(name: string) {
 		return this.entries.some(e => e.dependencies.some(s => s.includes(name)));
 	}
 
+	/* Note: The caller is responsible for removing the entry from its scope. */
 	removeEntry(entry: ConfigEntry) {
 		var i = this.entries.indexOf(entry);
-		this.entries.splice(i, 1);
-		if (entry.scope) {
-			i = entry.scope.children.indexOf(entry);
-			entry.scope.children.splice(i, 1);
+		if (i > -1) {
+			this.entries.splice(i, 1);
 		}
 
 		if (this.entries.length === 0) {
@@ -352,28 +416,30 @@ export class Config {
 			case 'tristate':
 				return ['y', 'n', 'm'].includes(overrideValue);
 			case 'hex':
-				return !!overrideValue.match(/^0x[a-fA-F\d]+$/);
+				return hexValueMatch.test(overrideValue);
 			case 'int':
-				return !!overrideValue.match(/^\d+$/);
+				return intValueMatch.test(overrideValue);
 			case 'string':
-				return !!overrideValue.match(/^"[^"]*"/);
+				return stringValueMatch.test(overrideValue);
 			default:
 				return false;
 		}
 	}
 
-	defaultValue(ctx: EvalContext): ConfigValue | undefined {
+	defaultValue(ctx: EvalContext, activeEntries?: ConfigEntry[]): ConfigValue | undefined {
+		if (this.name in ctx.defaults) {
+			return ctx.defaults[this.name];
+		}
+
 		var dflt: ConfigDefault | undefined;
-		this.activeEntries(ctx).some(e => {
+		(activeEntries ?? this.activeEntries(ctx)).some(e => {
 			dflt = e.defaults.find(d => !d.condition || d.condition.solve(ctx) === true);
 			return dflt !== undefined;
 		});
 
-		if (dflt !== undefined) {
-			return resolveExpression(dflt.value, ctx);
-		}
-
-		return undefined;
+		var value = (dflt !== undefined) ? resolveExpression(dflt.value, ctx) : undefined;
+		ctx.defaults[this.name] = value;
+		return value;
 	}
 
 	isEnabled(value: string) {
@@ -421,9 +487,9 @@ export class Config {
 		}
 	}
 
-	getRange(ctx: EvalContext): {min: number, max: number} {
+	getRange(ctx: EvalContext, activeEntries?: ConfigEntry[]): {min: number, max: number} {
 		var range: ConfigValueRange | undefined;
-		this.activeEntries(ctx).find(e => {
+		(activeEntries ?? this.activeEntries(ctx)).find(e => {
 			range = e.ranges.find(r => r.condition === undefined || r.condition.solve(ctx) === true);
 			return range;
 		});
@@ -440,9 +506,9 @@ export class Config {
 	}
 
 	evaluateSymbol(name: string, ctx: EvalContext): ConfigValue {
-		if (name.match(/^\s*(0x[\da-fA-F]+|[\-+]?\d+)\s*$/)) {
+		if (numberSymbolMatch.test(name)) {
 			return Number(name);
-		} else if (name.match(/^\s*[ynm]\s*$/)) {
+		} else if (tristateSymbolMatch.test(name)) {
 			return name.trim() !== 'n';
 		}
 
@@ -476,7 +542,7 @@ export class Config {
 			return undefined;
 		}
 
-		var select = ctx.repo.configList.find(
+		var select = ctx.repo.selectorsOf(this.name).find(
 			c => (
 				(c.type === 'bool' || c.type === 'tristate') &&
 				!c.hasDependency(this.name) &&
@@ -511,34 +577,35 @@ export class Config {
 
 	evaluate(ctx: EvalContext): ConfigValue {
 		// Check cached result first:
-		var result = ctx.resolve(this);
+		var result = ctx.resolve(this.name);
 		if (result !== undefined) {
 			return result;
 		}
 
 		// All dependencies must be true
 		if (this.missingDependency(ctx)) {
-			return ctx.register(this, false);
+			return ctx.register(this.name, false);
 		}
 
-		if (!this.entries.some(e => e.type && e.isActive(ctx))) {
-			return ctx.register(this, false);
+		var activeEntries = this.activeEntries(ctx);
+		if (!activeEntries.some(e => e.type)) {
+			return ctx.register(this.name, false);
 		}
 
-		var override = ctx.overrides.find(o => o.config.name === this.name);
+		var override = ctx.override(this.name);
 		if (override) {
-			return ctx.register(this, this.resolveValueString(override.value));
+			return ctx.register(this.name, this.resolveValueString(override.value));
 		}
 
-		var dflt = this.defaultValue(ctx);
+		var dflt = this.defaultValue(ctx, activeEntries);
 		if (dflt !== undefined) {
-			return ctx.register(this, dflt);
+			return ctx.register(this.name, dflt);
 		}
 
 		if (this.type === "bool" || this.type === "tristate") {
 			var selected = !!this.selector(ctx);
 			if (selected) {
-				return ctx.register(this, selected);
+				return ctx.register(this.name, selected);
 			}
 
 			if (this.entries[0].scope instanceof ChoiceScope && this.entries[0].scope.choice.chosen(ctx) === this) {
@@ -546,7 +613,7 @@ export class Config {
 			}
 		}
 
-		return ctx.register(this, this.falseValue(ctx));
+		return ctx.register(this.name, this.falseValue(ctx));
 	}
 
 	symbolKind(): vscode.SymbolKind {
@@ -604,7 +671,21 @@ export class ChoiceEntry extends ConfigEntry {
 	}
 
 	chosen(ctx: EvalContext): Config | undefined {
-		var c = this.choices.find(c => ctx.overrides.some(o => o.config === c && c.resolveValueString(o.value)));
+		// Every choice option asks for this while evaluating, cache it:
+		if (ctx.chosen.has(this)) {
+			return ctx.chosen.get(this);
+		}
+
+		var chosen = this.resolveChoice(ctx);
+		ctx.chosen.set(this, chosen);
+		return chosen;
+	}
+
+	private resolveChoice(ctx: EvalContext): Config | undefined {
+		var c = this.choices.find(c => {
+			var o = ctx.override(c.name);
+			return o && c.resolveValueString(o.value);
+		});
 		if (c) {
 			return c;
 		}
@@ -620,10 +701,33 @@ export class ChoiceEntry extends ConfigEntry {
 	}
 }
 
+function diagEqual(a: vscode.Diagnostic, b: vscode.Diagnostic): boolean {
+	return a.message === b.message &&
+		a.severity === b.severity &&
+		a.range.isEqual(b.range) &&
+		a.code === b.code &&
+		a.source === b.source &&
+		(a.tags ?? []).length === (b.tags ?? []).length &&
+		(a.tags ?? []).every((tag, i) => tag === b.tags![i]) &&
+		(a.relatedInformation ?? []).length === (b.relatedInformation ?? []).length &&
+		(a.relatedInformation ?? []).every((info, i) => (
+			info.message === b.relatedInformation![i].message &&
+			info.location.uri.toString() === b.relatedInformation![i].location.uri.toString() &&
+			info.location.range.isEqual(b.relatedInformation![i].location.range)));
+}
+
+export function diagsEqual(a: readonly vscode.Diagnostic[], b: readonly vscode.Diagnostic[]): boolean {
+	return a.length === b.length && a.every((d, i) => diagEqual(d, b[i]));
+}
+
 export class Repository {
 	configs: {[name: string]: Config};
 
 	private cachedConfigList?: Config[];
+	private cachedFiles?: ParsedFile[];
+	private cachedFileIndex?: {[fsPath: string]: ParsedFile[]};
+	private cachedSelectors?: {[name: string]: Config[]};
+	revision: number;
 	root?: ParsedFile;
 	rootScope: RootScope;
 	diags: vscode.DiagnosticCollection;
@@ -633,8 +737,9 @@ export class Repository {
 		this.configs = {};
 		this.diags = diags;
 		this.openEditors = vscode.window.visibleTextEditors.filter(e => e.document.languageId === "kconfig").map(e => e.document.uri);
-		this.openEditors.forEach(uri => this.setDiags(uri));
+		this.setDiags(this.openEditors);
 		this.cachedConfigList = [];
+		this.revision = 0;
 		this.rootScope = new RootScope(this);
 	}
 
@@ -642,11 +747,13 @@ export class Repository {
 		context.subscriptions.push(vscode.window.onDidChangeVisibleTextEditors(e => {
 			e = e.filter(e => e.document.languageId === 'kconfig');
 			var newUris = e.map(e => e.document.uri);
-			var removed = this.openEditors.filter(old => !newUris.some(uri => uri.fsPath === old.fsPath));
-			var added = newUris.filter(newUri => !this.openEditors.some(uri => uri.fsPath === newUri.fsPath));
+			var newPaths = new Set(newUris.map(uri => uri.fsPath));
+			var oldPaths = new Set(this.openEditors.map(uri => uri.fsPath));
+			var removed = this.openEditors.filter(old => !newPaths.has(old.fsPath));
+			var added = newUris.filter(newUri => !oldPaths.has(newUri.fsPath));
 
 			removed.forEach(removed => this.diags.delete(removed));
-			added.forEach(add => this.setDiags(add));
+			this.setDiags(added);
 
 			this.openEditors = newUris;
 		}));
@@ -664,35 +771,114 @@ export class Repository {
 		this.configs = {};
 		this.rootScope.reset();
 		this.root = new ParsedFile(this, uri, {}, this.rootScope);
+		this.invalidate();
 	}
 
 	parse() {
-		this.cachedConfigList = undefined;
 		this.root?.parse();
-		this.openEditors.forEach(uri => this.setDiags(uri));
-		this.printStats();
+		this.invalidate();
+		this.setDiags(this.openEditors);
+		if (kEnv.isDebugging()) {
+			this.printStats();
+		}
 	}
 
 	reset() {
 		this.rootScope.reset();
 		this.configs = {};
+		this.invalidate();
+	}
+
+	/* Drop all caches derived from the parsed files: */
+	invalidate() {
 		this.cachedConfigList = undefined;
+		this.cachedFiles = undefined;
+		this.cachedFileIndex = undefined;
+		this.cachedSelectors = undefined;
+		this.revision++;
 	}
 
-	get files(): ParsedFile[] { // TODO: optimize to a managed dict?
+	get files(): ParsedFile[] {
 		if (!this.root) {
 			return [];
 		}
 
-		return [this.root, ...this.root.children()];
+		if (!this.cachedFiles) {
+			this.cachedFiles = [this.root, ...this.root.children()];
+		}
+
+		return this.cachedFiles;
 	}
 
-	setDiags(uri: vscode.Uri) {
-		this.diags.set(uri,
-			this.files
-				.filter(f => f.uri.fsPath === uri.fsPath)
-				.map(f => f.diags)
-				.reduce((sum, diags) => sum.concat(diags.filter(d => !sum.some(existing => existing.range.start.line === d.range.start.line))), []));
+	/* All parsed versions of the given file: */
+	filesAt(uri: vscode.Uri): ParsedFile[] {
+		if (!this.cachedFileIndex) {
+			var index: {[fsPath: string]: ParsedFile[]} = {};
+			this.files.forEach(f => {
+				if (f.uri.fsPath in index) {
+					index[f.uri.fsPath].push(f);
+				} else {
+					index[f.uri.fsPath] = [f];
+				}
+			});
+			this.cachedFileIndex = index;
+		}
+
+		return this.cachedFileIndex[uri.fsPath] ?? [];
+	}
+
+	/* All configs that select or imply the given config, in config list order: */
+	selectorsOf(name: string): Config[] {
+		if (!this.cachedSelectors) {
+			var index: {[name: string]: Config[]} = {};
+			this.configList.forEach(c => {
+				c.entries.forEach(e => {
+					[...e.selects, ...e.implys].forEach(s => {
+						if (!(s.name in index)) {
+							index[s.name] = [c];
+						} else if (index[s.name][index[s.name].length - 1] !== c) {
+							index[s.name].push(c);
+						}
+					});
+				});
+			});
+			this.cachedSelectors = index;
+		}
+
+		return this.cachedSelectors[name] ?? [];
+	}
+
+	setDiags(uris: vscode.Uri[]) {
+		// Publish all changed files in one go to avoid repeated updates of the problems view:
+		var changed: [vscode.Uri, vscode.Diagnostic[]][] = [];
+		// A file may be open in several editors. The collection merges entries for the same uri, so only add each once:
+		var seen = new Set<string>();
+		uris.forEach(uri => {
+			if (seen.has(uri.fsPath)) {
+				return;
+			}
+
+			seen.add(uri.fsPath);
+
+			// The same file may be parsed several times with different environments.
+			// Only report the first diagnostic on each line:
+			var diags: vscode.Diagnostic[] = [];
+			var lines = new Set<number>();
+			this.filesAt(uri).forEach(f => {
+				var fileDiags = f.diags.filter(d => !lines.has(d.range.start.line));
+				fileDiags.forEach(d => lines.add(d.range.start.line));
+				diags.push(...fileDiags);
+			});
+
+			// Republishing identical diagnostics makes VS Code re-render the problems view:
+			if (!diagsEqual(this.diags.get(uri) ?? [], diags)) {
+				changed.push([uri, diags]);
+			}
+		});
+
+		if (changed.length > 0) {
+			this.diags.set(changed);
+		}
 	}
 
 	onDidChange(uri: vscode.Uri, change?: vscode.TextDocumentChangeEvent) {
@@ -700,19 +886,22 @@ export class Repository {
 			return;
 		}
 
-		var hrTime = process.hrtime();
-
-		var files = this.files.filter(f => f.uri.fsPath === uri.fsPath);
+		var files = this.filesAt(uri);
 		if (!files.length) {
 			return;
 		}
 
-		this.cachedConfigList = undefined;
+		// Timing is only reported when debugging:
+		var hrTime = kEnv.isDebugging() ? process.hrtime() : undefined;
+
 		files.forEach(f => f.onDidChange(change));
-		hrTime = process.hrtime(hrTime);
+		this.invalidate();
+		if (hrTime) {
+			hrTime = process.hrtime(hrTime);
+		}
 
-		this.openEditors.forEach(uri => this.setDiags(uri));
-		if (vscode.debug.activeDebugSession) {
+		this.setDiags(this.openEditors);
+		if (hrTime) {
 			console.log(`Handled changes to ${files.length} versions of ${uri.fsPath} in ${hrTime[0] * 1000 + hrTime[1] / 1000000} ms.`);
 			this.printStats();
 		}
@@ -721,15 +910,29 @@ export class Repository {
 	printStats() {
 		console.log(`\tFiles: ${this.files.length}`);
 		console.log(`\tConfigs: ${this.configList.length}`);
-		console.log(`\tEmpty configs: ${this.configList.filter(c => c.entries.length === 0).length}`);
-		var entriesC = this.configList.map(c => c.entries).reduce((sum, num) => [...sum, ...num], []);
-		console.log(`\tEntries: ${entriesC.length}`);
-
-		var scopeEntries = (s: Scope) : ConfigEntry[] => {
-			return s.children.map(c => (c instanceof Comment) ? [] : (c instanceof Scope) ? scopeEntries(c) : (c.config.kind === 'choice') ? [] : [c]).reduce((sum, num) => [...sum, ...num], []);
+		var emptyConfigs = 0;
+		var entries = 0;
+		this.configList.forEach(c => {
+			if (c.entries.length === 0) {
+				emptyConfigs++;
+			}
+			entries += c.entries.length;
+		});
+		console.log(`\tEmpty configs: ${emptyConfigs}`);
+		console.log(`\tEntries: ${entries}`);
+
+		var scopeEntries = (s: Scope): number => {
+			var count = 0;
+			s.children.forEach(c => {
+				if (c instanceof Scope) {
+					count += scopeEntries(c);
+				} else if (!(c instanceof Comment) && c.config.kind !== 'choice') {
+					count++;
+				}
+			});
+			return count;
 		};
-		var entriesS = scopeEntries(this.rootScope);
-		console.log(`\tEntries from scopes: ${entriesS.length}`);
+		console.log(`\tEntries from scopes: ${scopeEntries(this.rootScope)}`);
 
 		// console.log(`\tMissing Scope entries: ${entriesC.filter(e => !entriesS.includes(e)).map(e => e.config.name)}`);
 		// console.log(`\tMissing Config entries: ${entriesS.filter(e => !entriesC.includes(e)).map(e => e.config.name)}`);
@@ -5,6 +5,7 @@
  */
 import * as vscode from 'vscode';
 import * as path from 'path';
+import * as fs from 'fs';
 import * as glob from "glob";
 import { Repository, Scope, Config, ConfigValueType, ConfigEntry, ConfigKind, IfScope, MenuScope, ChoiceScope, ChoiceEntry, Comment } from "./kconfig";
 import * as kEnv from './env';
@@ -12,6 +13,32 @@ import { createExpression } from './evaluate';
 
 type FileInclusion = {range: vscode.Range, file: ParsedFile};
 
+const configMatch    = /^\s*(menuconfig|config)\s+(\w+)/;
+const sourceMatch    = /^(\s*(o)?(r)?source\s+)"((?:.*?[^\\])?)"/;
+const choiceMatch    = /^\s*choice(?:\s+(\w+))?/;
+const endChoiceMatch = /^\s*endchoice\b/;
+const ifMatch        = /^\s*if\s+([^#]+)/;
+const endifMatch     = /^\s*endif\b/;
+const menuMatch      = /^\s*((?:main)?menu)\s+"((?:.*?[^\\])?)"/;
+const endMenuMatch   = /^\s*endmenu\b/;
+const depOnMatch     = /^\s*depends\s+on\s+([^#]+)/;
+const envMatch       = /^\s*([\w\-]+)\s*=\s*([^#]+)/;
+const typeMatch      = /^\s*(bool|tristate|string|hex|int)(?:\s+"((?:.*?[^\\])?)")?/;
+const selectMatch    = /^\s*(?:select|imply)\s+(\w+)(?:\s+if\s+([^#]+))?/;
+const promptMatch    = /^\s*prompt\s+"((?:.*?[^\\])?)"/;
+const helpMatch      = /^\s*help\b/;
+const defaultMatch   = /^\s*default\s+([^#]+)/;
+const visibleMatch   = /^\s*visible\s+if\s+([^#]+)/;
+const defMatch       = /^\s*def_(bool|tristate|int|hex)\s+([^#]+)/;
+const defStringMatch = /^\s*def_string\s+"((?:.*?[^\\])?)"(?:\s+if\s+([^#]+))?/;
+const rangeMatch     = /^\s*range\s+([\-+]?\w+|\$\(.*?\))\s+([\-+]?\w+|\$\(.*?\))(?:\s+if\s+([^#]+))?/;
+const commentMatch   = /^\s*comment\s+"(.*)"/;
+const optionalMatch  = /^\s*optional\b/;
+const macroMatch     = /^\s*\w+\s*:\=.*/;
+const conditionMatch = /(.*)if\s+([^#]+)/;
+const emptyLineMatch = /^\s*(#|$)/;
+const indentMatch    = /^\s*/;
+
 export class ParsedFile {
 	// Some properties are immutable, and are part of the file's identification:
 	readonly uri: vscode.Uri;
@@ -63,7 +90,7 @@ export class ParsedFile {
 	onDidChange(change?: vscode.TextDocumentChangeEvent) {
 		if (change) {
 			if (change.document.version === this.version) {
-				console.log(`Duplicate version of ${change.document.fileName}`);
+				kEnv.debugLog(`Duplicate version of ${change.document.fileName}`);
 				return;
 			}
 			this.version = change.document.version;
@@ -78,7 +105,7 @@ export class ParsedFile {
 
 		this.wipeEntries();
 
-		this.parseRaw(change ? change.document.getText() : kEnv.readFile(this.uri));
+		this.parseRaw(change ? kEnv.documentLines(change.document) : this.readLines());
 
 		this.inclusions.forEach(i => {
 			var existingIndex: number;
@@ -100,9 +127,24 @@ export class ParsedFile {
 	}
 
 	wipeEntries() {
-		this.entries.splice(0).forEach(e => {
-			e.config.removeEntry(e);
+		var entries = this.entries.splice(0);
+		if (!entries.length) {
+			return;
+		}
+
+		// Scopes may have lots of children. Filter each scope once instead of splicing out every entry:
+		var removed = new Set<Scope | ConfigEntry | Comment>(entries);
+		var scopes = new Set<Scope>();
+		entries.forEach(e => {
+			if (e.scope) {
+				scopes.add(e.scope);
+			}
+		});
+		scopes.forEach(s => {
+			s.children = s.children.filter(c => !removed.has(c));
 		});
+
+		entries.forEach(e => e.config.removeEntry(e));
 	}
 
 	delete() {
@@ -130,13 +172,17 @@ export class ParsedFile {
 		return files;
 	}
 
+	private readLines(): string[] {
+		return kEnv.readFile(this.uri).split(/\r?\n/g);
+	}
+
 	parse() {
-		this.parseRaw(kEnv.readFile(this.uri));
+		this.parseRaw(this.readLines());
 
 		this.inclusions.forEach(i => i.file.parse());
 	}
 
-	private parseRaw(text: string) {
+	private parseRaw(lines: string[]) {
 		this.reset();
 		var choice: ChoiceEntry | null = null;
 		var env = {...this.env};
@@ -145,11 +191,6 @@ export class ParsedFile {
 			choice = scope.choice;
 		}
 
-		var lines = text.split(/\r?\n/g);
-		if (!lines) {
-			return;
-		}
-
 		var setScope = (s: Scope) => {
 			if (s && scope) {
 				scope = scope.addScope(s);
@@ -171,34 +212,23 @@ export class ParsedFile {
 			}
 		};
 
-		const configMatch    = /^\s*(menuconfig|config)\s+(\w+)/;
-		const sourceMatch    = /^(\s*(o)?(r)?source\s+)"((?:.*?[^\\])?)"/;
-		const choiceMatch    = /^\s*choice(?:\s+(\w+))?/;
-		const endChoiceMatch = /^\s*endchoice\b/;
-		const ifMatch        = /^\s*if\s+([^#]+)/;
-		const endifMatch     = /^\s*endif\b/;
-		const menuMatch      = /^\s*((?:main)?menu)\s+"((?:.*?[^\\])?)"/;
-		const endMenuMatch   = /^\s*endmenu\b/;
-		const depOnMatch     = /^\s*depends\s+on\s+([^#]+)/;
-		const envMatch       = /^\s*([\w\-]+)\s*=\s*([^#]+)/;
-		const typeMatch      = /^\s*(bool|tristate|string|hex|int)(?:\s+"((?:.*?[^\\])?)")?/;
-		const selectMatch    = /^\s*(?:select|imply)\s+(\w+)(?:\s+if\s+([^#]+))?/;
-		const promptMatch    = /^\s*prompt\s+"((?:.*?[^\\])?)"/;
-		const helpMatch      = /^\s*help\b/;
-		const defaultMatch   = /^\s*default\s+([^#]+)/;
-		const visibleMatch   = /^\s*visible\s+if\s+([^#]+)/;
-		const defMatch       = /^\s*def_(bool|tristate|int|hex)\s+([^#]+)/;
-		const defStringMatch = /^\s*def_string\s+"((?:.*?[^\\])?)"(?:\s+if\s+([^#]+))?/;
-		const rangeMatch     = /^\s*range\s+([\-+]?\w+|\$\(.*?\))\s+([\-+]?\w+|\$\(.*?\))(?:\s+if\s+([^#]+))?/;
-
 		var entry: ConfigEntry | null = null;
 		var comment: Comment | null = null;
 		var help = false;
 		var helpIndent: string | null = null;
+		// Collect the help text in pieces, and only join them once the help block ends:
+		var helpText: string[] = [];
+		var line: string;
+		var startLineNumber: number;
+
+		// Only create ranges and diagnostics for the current line when they're actually reported:
+		var lineRange = () => new vscode.Range(startLineNumber, 0, lineNumber, line.length);
+		var noEntryDiag = () => new vscode.Diagnostic(lineRange(), `Token is only valid in an entry context`, vscode.DiagnosticSeverity.Warning);
+
 		for (var lineNumber = 0; lineNumber < lines.length; lineNumber++) {
-			var line = kEnv.replace(lines[lineNumber], env);
+			line = kEnv.replace(lines[lineNumber], env);
 
-			var startLineNumber = lineNumber;
+			startLineNumber = lineNumber;
 
 			/* If lines end with \, the line ending should be ignored: */
 			while (line.endsWith('\\') && lineNumber < lines.length - 1) {
@@ -206,28 +236,26 @@ export class ParsedFile {
 			}
 
 			if (line.length === 0) {
-				if (help && entry?.help) {
-					entry.help += '\n\n';
+				if (help && helpText.length > 0) {
+					helpText.push('\n\n');
 				}
 				continue;
 			}
 
-			var lineRange = new vscode.Range(startLineNumber, 0, lineNumber, line.length);
-
 			if (help) {
-				var indent = line.replace(/\t/g, ' '.repeat(8)).match(/^\s*/)![0];
+				var indent = line.match(indentMatch)![0].replace(/\t/g, '        ');
 				if (helpIndent === null) {
 					helpIndent = indent;
 				}
 				if (indent.startsWith(helpIndent)) {
 					if (entry) {
-						entry.help += ' ' + line.trim();
+						helpText.push(' ' + line.trim());
 						entry.extend(lineNumber);
 					}
 				} else {
 					help = false;
-					if (entry && entry.help) {
-						entry.help = entry.help.trim();
+					if (entry) {
+						entry.help = helpText.join('').trim();
 					}
 				}
 			}
@@ -236,7 +264,7 @@ export class ParsedFile {
 				continue;
 			}
 
-			if (line.match(/^\s*(#|$)/)) {
+			if (emptyLineMatch.test(line)) {
 				continue;
 			}
 
@@ -272,17 +300,21 @@ export class ParsedFile {
 					baseDir = kEnv.getRoot();
 				}
 				let includeFile = kEnv.resolvePath(match[4], baseDir);
-				let range = new vscode.Range(
-					new vscode.Position(lineNumber, match[1].length + 1),
-					new vscode.Position(lineNumber, match[0].length - 1));
+				let range = new vscode.Range(lineNumber, match[1].length + 1, lineNumber, match[0].length - 1);
 				if (includeFile.scheme === 'file') {
-					let matches = glob.sync(includeFile.fsPath);
+					let matches: vscode.Uri[];
+					// Most source statements are plain paths. Skip the glob and reuse the resolved uri for those:
+					if (glob.hasMagic(includeFile.fsPath)) {
+						matches = glob.sync(includeFile.fsPath).map(match => vscode.Uri.file(match));
+					} else {
+						matches = fs.existsSync(includeFile.fsPath) ? [includeFile] : [];
+					}
 					matches.forEach(match => {
-						this.inclusions.push({range: range, file: new ParsedFile(this.repo, vscode.Uri.file(match), env, scope, this)});
+						this.inclusions.push({range: range, file: new ParsedFile(this.repo, match, env, scope, this)});
 					});
 					if (matches.length === 0 && !optional) {
-						console.log(`Unable to resolve include ${match[4]} @ ${this.uri.fsPath}:L${lineNumber + 1}`);
-						this.diags.push(new vscode.Diagnostic(lineRange, 'Unable to resolve include'));
+						kEnv.debugLog(`Unable to resolve include ${match[4]} @ ${this.uri.fsPath}:L${lineNumber + 1}`);
+						this.diags.push(new vscode.Diagnostic(lineRange(), 'Unable to resolve include'));
 					}
 				} else {
 					this.inclusions.push({range: range, file: new ParsedFile(this.repo, includeFile, env, scope, this)});
@@ -305,7 +337,7 @@ export class ParsedFile {
 					scope.lines.end = lineNumber;
 					scope = scope.parent!;
 				} else {
-					this.diags.push(new vscode.Diagnostic(lineRange, `Unexpected endchoice`, vscode.DiagnosticSeverity.Error));
+					this.diags.push(new vscode.Diagnostic(lineRange(), `Unexpected endchoice`, vscode.DiagnosticSeverity.Error));
 					unterminatedScope(scope);
 				}
 				continue;
@@ -323,7 +355,7 @@ export class ParsedFile {
 					scope.lines.end = lineNumber;
 					scope = scope.parent;
 				} else {
-					this.diags.push(new vscode.Diagnostic(lineRange, `Unexpected endif`, vscode.DiagnosticSeverity.Error));
+					this.diags.push(new vscode.Diagnostic(lineRange(), `Unexpected endif`, vscode.DiagnosticSeverity.Error));
 					unterminatedScope(scope);
 				}
 				continue;
@@ -341,7 +373,7 @@ export class ParsedFile {
 					scope.lines.end = lineNumber;
 					scope = scope.parent;
 				} else {
-					this.diags.push(new vscode.Diagnostic(lineRange, `Unexpected endmenu`, vscode.DiagnosticSeverity.Error));
+					this.diags.push(new vscode.Diagnostic(lineRange(), `Unexpected endmenu`, vscode.DiagnosticSeverity.Error));
 					unterminatedScope(scope);
 				}
 				continue;
@@ -353,13 +385,13 @@ export class ParsedFile {
 					entry.extend(lineNumber);
 
 					if (entry.dependencies.includes(depOn)) {
-						this.diags.push(new vscode.Diagnostic(lineRange, `Duplicate dependency`, vscode.DiagnosticSeverity.Warning));
+						this.diags.push(new vscode.Diagnostic(lineRange(), `Duplicate dependency`, vscode.DiagnosticSeverity.Warning));
 					}
 					entry.dependencies.push(depOn); // need to push the duplicate, in case someone changes the other location to remove the duplication
 				} else if (scope instanceof MenuScope) {
 					scope.dependencies.push(depOn);
 				} else {
-					this.diags.push(new vscode.Diagnostic(lineRange, `Unexpected depends on`, vscode.DiagnosticSeverity.Error));
+					this.diags.push(new vscode.Diagnostic(lineRange(), `Unexpected depends on`, vscode.DiagnosticSeverity.Error));
 					unterminatedScope(scope);
 				}
 				continue;
@@ -376,11 +408,11 @@ export class ParsedFile {
 				if (scope instanceof MenuScope && !entry) {
 					scope.visible = createExpression(match[1]);
 				} else {
-					this.diags.push(new vscode.Diagnostic(lineRange, `Only valid for menus`, vscode.DiagnosticSeverity.Error));
+					this.diags.push(new vscode.Diagnostic(lineRange(), `Only valid for menus`, vscode.DiagnosticSeverity.Error));
 				}
 				continue;
 			}
-			match = line.match(/^\s*comment\s+"(.*)"/);
+			match = line.match(commentMatch);
 			if (match) {
 				comment = new Comment(match[1], this, lineNumber);
 				if (scope) {
@@ -389,12 +421,10 @@ export class ParsedFile {
 				continue;
 			}
 
-			var noEntryDiag = new vscode.Diagnostic(lineRange, `Token is only valid in an entry context`, vscode.DiagnosticSeverity.Warning);
-
 			match = line.match(typeMatch);
 			if (match) {
 				if (!entry) {
-					this.diags.push(noEntryDiag);
+					this.diags.push(noEntryDiag());
 					continue;
 				}
 				entry.type = match[1] as ConfigValueType;
@@ -408,7 +438,7 @@ export class ParsedFile {
 			match = line.match(selectMatch);
 			if (match) {
 				if (!entry) {
-					this.diags.push(noEntryDiag);
+					this.diags.push(noEntryDiag());
 					continue;
 				}
 				entry.selects.push({name: match[1], condition: createExpression(match[2])});
@@ -418,7 +448,7 @@ export class ParsedFile {
 			match = line.match(promptMatch);
 			if (match) {
 				if (!entry) {
-					this.diags.push(noEntryDiag);
+					this.diags.push(noEntryDiag());
 					continue;
 				}
 				entry.text = match[1];
@@ -429,11 +459,12 @@ export class ParsedFile {
 			match = line.match(helpMatch);
 			if (match) {
 				if (!entry) {
-					this.diags.push(noEntryDiag);
+					this.diags.push(noEntryDiag());
 					continue;
 				}
 				help = true;
 				helpIndent = null;
+				helpText = [];
 				entry.help = '';
 				entry.extend(lineNumber);
 				continue;
@@ -443,10 +474,10 @@ export class ParsedFile {
 			match = line.match(defaultMatch);
 			if (match) {
 				if (!entry) {
-					this.diags.push(noEntryDiag);
+					this.diags.push(noEntryDiag());
 					continue;
 				}
-				ifStatement = match[1].match(/(.*)if\s+([^#]+)/);
+				ifStatement = match[1].match(conditionMatch);
 				if (ifStatement) {
 					entry.defaults.push({ value: ifStatement[1], condition: createExpression(ifStatement[2]) });
 				} else {
@@ -458,11 +489,11 @@ export class ParsedFile {
 			match = line.match(defMatch);
 			if (match) {
 				if (!entry) {
-					this.diags.push(noEntryDiag);
+					this.diags.push(noEntryDiag());
 					continue;
 				}
 				entry.type = match[1] as ConfigValueType;
-				ifStatement = match[2].match(/(.*)if\s+([^#]+)/);
+				ifStatement = match[2].match(conditionMatch);
 				if (ifStatement) {
 					entry.defaults.push({ value: ifStatement[1], condition: createExpression(ifStatement[2]) });
 				} else {
@@ -474,11 +505,11 @@ export class ParsedFile {
 			match = line.match(defStringMatch);
 			if (match) {
 				if (!entry) {
-					this.diags.push(noEntryDiag);
+					this.diags.push(noEntryDiag());
 					continue;
 				}
 				entry.type = 'string';
-				ifStatement = match[1].match(/(.*)if\s+([^#]+)/);
+				ifStatement = match[1].match(conditionMatch);
 				if (ifStatement) {
 					entry.defaults.push({ value: ifStatement[1], condition: createExpression(ifStatement[2]) });
 				} else {
@@ -490,7 +521,7 @@ export class ParsedFile {
 			match = line.match(rangeMatch);
 			if (match) {
 				if (!entry) {
-					this.diags.push(noEntryDiag);
+					this.diags.push(noEntryDiag());
 					continue;
 				}
 				entry.ranges.push({
@@ -502,21 +533,26 @@ export class ParsedFile {
 				continue;
 			}
 
-			if (line.match(/^\s*optional\b/)) {
+			if (optionalMatch.test(line)) {
 				if (entry instanceof ChoiceEntry) {
 					entry.optional = true;
 				} else {
-					this.diags.push(new vscode.Diagnostic(lineRange, `Unexpected keyword, optional is only valid for choices.`, vscode.DiagnosticSeverity.Error));
+					this.diags.push(new vscode.Diagnostic(lineRange(), `Unexpected keyword, optional is only valid for choices.`, vscode.DiagnosticSeverity.Error));
 				}
 				continue;
 			}
 
-			if (line.match(/^\s*\w+\s*:\=.*/)) {
-				this.diags.push(new vscode.Diagnostic(lineRange, `Macros aren't supported, this will be ignored.`, vscode.DiagnosticSeverity.Warning));
+			if (macroMatch.test(line)) {
+				this.diags.push(new vscode.Diagnostic(lineRange(), `Macros aren't supported, this will be ignored.`, vscode.DiagnosticSeverity.Warning));
 				continue;
 			}
 
-			this.diags.push(new vscode.Diagnostic(lineRange, `Invalid token`, vscode.DiagnosticSeverity.Error));
+			this.diags.push(new vscode.Diagnostic(lineRange(), `Invalid token`, vscode.DiagnosticSeverity.Error));
+		}
+
+		// The file may end in the middle of a help block:
+		if (help && entry) {
+			entry.help = helpText.join('').trim();
 		}
 	}
 }
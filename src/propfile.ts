@@ -4,12 +4,22 @@
  * SPDX-License-Identifier: MIT
  */
 import * as vscode from 'vscode';
-import { ConfigOverride, Repository, EvalContext } from "./kconfig";
+import { ConfigOverride, Repository, EvalContext, diagsEqual } from "./kconfig";
 import { Token, makeExpr, tokenizeExpression, TokenKind } from './evaluate';
+import * as kEnv from './env';
+
+const configLineMatch = /^\s*CONFIG_([^\s=]+)\s*(.*)/;
+const emptyLineMatch = /^\s*(#|$)/;
+const assignmentMatch = /(=\s*)(".*?[^\\]"|""|\w+)/;
+const trailingMatch = /^\s*([^#\s]+[^#]*)/;
+const stringValueMatch = /^"(.*)"$/;
+
+type ParsedLine = { line: number, override?: ConfigOverride, diags: vscode.Diagnostic[] };
 
 export class PropFile {
 	actions: vscode.CodeAction[] = [];
 	conf: ConfigOverride[] = [];
+	confByName: { [name: string]: ConfigOverride } = {};
 	baseConf: ConfigOverride[];
 	repo: Repository;
 	uri: vscode.Uri;
@@ -18,6 +28,11 @@ export class PropFile {
 	private parseDiags: vscode.Diagnostic[] = [];
 	private lintDiags: vscode.Diagnostic[] = [];
 	private version: number;
+	private docVersion?: number;
+	private docRevision?: number;
+	private parsedLines = new Map<string, ParsedLine>();
+	private parsedLinesRevision?: number;
+	private publishedDiags?: vscode.Diagnostic[];
 
 	constructor(uri: vscode.Uri, repo: Repository, baseConf: ConfigOverride[], diags: vscode.DiagnosticCollection) {
 		this.uri = uri;
@@ -32,13 +47,12 @@ export class PropFile {
 	}
 
 	parseLine(line: string, lineNumber: number): ConfigOverride | undefined {
-		var thisLine = new vscode.Position(lineNumber, 0);
-		var match = line.match(/^\s*CONFIG_([^\s=]+)\s*(.*)/);
+		var match = line.match(configLineMatch);
 		if (!match) {
-			if (!line.match(/^\s*(#|$)/)) {
+			if (!emptyLineMatch.test(line)) {
 				this.parseDiags.push(
 					new vscode.Diagnostic(
-						new vscode.Range(thisLine, thisLine),
+						new vscode.Range(lineNumber, 0, lineNumber, 0),
 						"Syntax error: All lines must either be comments or config entries with values.",
 						vscode.DiagnosticSeverity.Error
 					)
@@ -47,11 +61,11 @@ export class PropFile {
 			return undefined;
 		}
 
-		var valueMatch = match[2].match(/(=\s*)(".*?[^\\]"|""|\w+)/);
+		var valueMatch = match[2].match(assignmentMatch);
 		if (!valueMatch) {
 			this.parseDiags.push(
 				new vscode.Diagnostic(
-					new vscode.Range(thisLine, thisLine),
+					new vscode.Range(lineNumber, 0, lineNumber, 0),
 					"Missing value for config " + match[1],
 					vscode.DiagnosticSeverity.Error
 				)
@@ -63,7 +77,7 @@ export class PropFile {
 		if (!entry) {
 			this.parseDiags.push(
 				new vscode.Diagnostic(
-					new vscode.Range(thisLine, thisLine),
+					new vscode.Range(lineNumber, 0, lineNumber, 0),
 					"Unknown entry " + match[1],
 					vscode.DiagnosticSeverity.Error
 				)
@@ -102,12 +116,12 @@ export class PropFile {
 		}
 
 
-		var trailing = line.slice(match[0].length).match(/^\s*([^#\s]+[^#]*)/);
+		var trailing = line.slice(match[0].length).match(trailingMatch);
 		if (trailing) {
 			var start = match[0].length + trailing[0].indexOf(trailing[1]);
 			this.parseDiags.push(
 				new vscode.Diagnostic(
-					new vscode.Range(thisLine.line, start, thisLine.line, start + trailing[1].trimRight().length),
+					new vscode.Range(lineNumber, start, lineNumber, start + trailing[1].trimRight().length),
 					"Unexpected trailing characters",
 					vscode.DiagnosticSeverity.Error
 				)
@@ -116,7 +130,7 @@ export class PropFile {
 		}
 
 		var value: string;
-		var stringMatch = valueMatch[2].match(/^"(.*)"$/);
+		var stringMatch = valueMatch[2].match(stringValueMatch);
 		if (stringMatch) {
 			value = stringMatch[1];
 		} else {
@@ -127,24 +141,83 @@ export class PropFile {
 	}
 
 	updateDiags() {
-		this.diags.set(this.uri, [...this.parseDiags, ...this.lintDiags]);
+		var diags = [...this.parseDiags, ...this.lintDiags];
+		// Compare against our own copy, as the collection hands out the published diagnostic objects:
+		if (!this.publishedDiags || !diagsEqual(this.publishedDiags, diags)) {
+			this.diags.set(this.uri, diags);
+			this.publishedDiags = diags;
+		}
 	}
 
 	parse(text: string) {
+		this.parseLines(text.split(/\r?\n/g));
+	}
+
+	parseLines(lines: string[]) {
 		this.parseDiags = [];
 		this.conf = [];
 		this.version++;
-		console.log("Parsing...");
+		kEnv.debugLog("Parsing...");
 
-		var lines = text.split(/\r?\n/g);
+		this.confByName = {};
+
+		// Edits only touch a few lines at a time. Reuse the results for the other lines as long as the tree is unchanged:
+		var previous = this.parsedLines;
+		if (this.parsedLinesRevision !== this.repo.revision) {
+			previous = new Map<string, ParsedLine>();
+			this.parsedLinesRevision = this.repo.revision;
+		}
+
+		this.parsedLines = new Map<string, ParsedLine>();
+		lines.forEach((l, i) => {
+			var parsed = previous.get(l);
+			if (!parsed) {
+				var diagCount = this.parseDiags.length;
+				var override = this.parseLine(l, i);
+				parsed = { line: i, override: override, diags: this.parseDiags.slice(diagCount) };
+			} else {
+				if (parsed.line !== i) {
+					parsed = this.moveLine(parsed, i);
+				}
+				this.parseDiags.push(...parsed.diags);
+			}
+
+			this.parsedLines.set(l, parsed);
+
+			var c = parsed.override;
+			if (c) {
+				this.conf.push(c);
+				if (!(c.config.name in this.confByName)) {
+					this.confByName[c.config.name] = c;
+				}
+			}
+		});
 
-		this.conf = lines.map((l, i) => this.parseLine(l, i)).filter(c => c !== undefined) as ConfigOverride[];
 		this.updateDiags();
-		console.log("Parsing done.");
+		kEnv.debugLog("Parsing done.");
+	}
+
+	private moveLine(parsed: ParsedLine, line: number): ParsedLine {
+		return {
+			line: line,
+			override: parsed.override && { ...parsed.override, line: line },
+			diags: parsed.diags.map(diag => new vscode.Diagnostic(
+				new vscode.Range(line, diag.range.start.character, line, diag.range.end.character),
+				diag.message,
+				diag.severity
+			)),
+		};
 	}
 
 	reparse(d: vscode.TextDocument) {
-		this.parse(d.getText());
+		// Switching between editors reparses, but the contents and the tree may be the same as last time:
+		if (d.version === this.docVersion && this.repo.revision === this.docRevision) {
+			return;
+		}
+
+		this.parseLines(kEnv.documentLines(d));
+		this.docVersion = d.version;
+		this.docRevision = this.repo.revision;
 		this.scheduleLint();
 	}
 
@@ -157,6 +230,12 @@ export class PropFile {
 
 	private getDependencyOverrides(missingDependency: string, ctx: EvalContext) {
 		let entries: ConfigOverride[] = [];
+		// Keep track of the suggested values, so duplicates from the recursion can be skipped without rescanning entries:
+		let suggested = new Set<string>();
+		let addEntry = (e: ConfigOverride) => {
+			suggested.add(`${e.config.name}=${e.value}`);
+			entries.push(e);
+		};
 		let tokens = tokenizeExpression(missingDependency);
 		let variables = tokens
 			.filter(t => t.kind === TokenKind.VAR)
@@ -182,7 +261,7 @@ export class PropFile {
 				// have replaced all boolean VAR tokens with y or n depending on their bitfield value:
 				if (makeExpr(replacedTokens).solve(ctx)) {
 					replacements.forEach(r => {
-						let dup = this.conf.find(c => r.name === c.config.name);
+						let dup = this.confByName[r.name];
 						let entry = null;
 						if (!dup) {
 							entry = {config: ctx.repo.configs[r.name], value: r.value};
@@ -195,10 +274,12 @@ export class PropFile {
 						// Do this recursively to brute force our way up the dependency tree:
 						let entryDep = entry.config.missingDependency(ctx);
 						if (entryDep) {
-							entries.push(...this.getDependencyOverrides(entryDep, ctx).filter(e => !entries.some(existing => e.config.name === existing.config.name && e.value === existing.value)));
+							this.getDependencyOverrides(entryDep, ctx)
+								.filter(e => !suggested.has(`${e.config.name}=${e.value}`))
+								.forEach(addEntry);
 						}
 
-						entries.push(entry);
+						addEntry(entry);
 					});
 					break;
 				}
@@ -213,7 +294,7 @@ export class PropFile {
 			clearTimeout(this.timeout);
 		}
 
-		console.log("lint starting");
+		kEnv.debugLog("lint starting");
 		await this.skipTick();
 
 		var ctx = new EvalContext(this.repo, this.overrides);
@@ -222,8 +303,6 @@ export class PropFile {
 
 		var actions = <vscode.CodeAction[]>[];
 
-		var all = this.repo.configList;
-
 		var addRedundancyAction = (c: ConfigOverride, diag: vscode.Diagnostic) => {
 			var action = new vscode.CodeAction(`Remove redundant entry CONFIG_${c.config.name}`, vscode.CodeActionKind.QuickFix);
 			action.edit = new vscode.WorkspaceEdit();
@@ -237,25 +316,28 @@ export class PropFile {
 		for (var i = 0; i < this.conf.length; i++) {
 			await this.skipTick();
 			if (version !== this.version) {
-				console.log("Abandoning lint");
+				kEnv.debugLog("Abandoning lint");
 				return;
 			}
 
 			var c = this.conf[i];
+			var config = c.config;
+			var type = config.type;
+			var activeEntries = config.activeEntries(ctx);
 
-			var override = c.config.resolveValueString(c.value);
+			var override = config.resolveValueString(c.value);
 			var line = new vscode.Range(c.line!, 0, c.line!, 99999999);
 			var diag: vscode.Diagnostic;
 
-			if (!c.config.text) {
+			if (!config.text) {
 				diag = new vscode.Diagnostic(line,
-					`Entry ${c.config.name} has no effect (has no prompt)`,
+					`Entry ${config.name} has no effect (has no prompt)`,
 					vscode.DiagnosticSeverity.Warning);
 				diags.push(diag);
 				addRedundancyAction(c, diag);
 
 				// Find all selectors:
-				var selectors = all.filter(e => e.selects(ctx, c.config.name));
+				var selectors = this.repo.selectorsOf(config.name).filter(e => e.selects(ctx, config.name).length > 0);
 				actions.push(...selectors.map(s => {
 					var action = new vscode.CodeAction(`Replace with CONFIG_${s.name}`, vscode.CodeActionKind.QuickFix);
 					action.edit = new vscode.WorkspaceEdit();
@@ -265,8 +347,8 @@ export class PropFile {
 				}));
 			}
 
-			if (c.config.type && ['int', 'hex'].includes(c.config.type)) {
-				var range = c.config.getRange(ctx);
+			if (type === 'int' || type === 'hex') {
+				var range = config.getRange(ctx, activeEntries);
 				if ((range.min !== undefined && override < range.min) || (range.max !== undefined && override > range.max)) {
 					diags.push(new vscode.Diagnostic(line,
 						`Value ${c.value} outside range ${range.min}-${range.max}`,
@@ -275,14 +357,14 @@ export class PropFile {
 			}
 
 			// tslint:disable-next-line: triple-equals
-			if (override == c.config.defaultValue(ctx)) {
+			if (override == config.defaultValue(ctx, activeEntries)) {
 				let defaultValue = c.value;
-				if (c.config.type === 'bool') {
+				if (type === 'bool') {
 					defaultValue = c.value === 'y' ? 'enabled' : 'disabled';
 				}
 
 				diag = new vscode.Diagnostic(line,
-					`Entry ${c.config.name} is ${defaultValue} by default`,
+					`Entry ${config.name} is ${defaultValue} by default`,
 					vscode.DiagnosticSeverity.Hint);
 				diag.tags = [vscode.DiagnosticTag.Unnecessary];
 				diags.push(diag);
@@ -290,7 +372,7 @@ export class PropFile {
 				addRedundancyAction(c, diag);
 			}
 
-			var missingDependencies = c.config.missingDependencies(ctx);
+			var missingDependencies = config.missingDependencies(ctx);
 			if (missingDependencies.length) {
 				let depText = missingDependencies.length > 1 ? `dependencies` : `dependency ${missingDependencies[0]}`;
 				if (c.value === 'n') {
@@ -305,7 +387,7 @@ export class PropFile {
 				}
 
 				diag = new vscode.Diagnostic(line,
-					`Entry ${c.config.name}: failing ${depText}`,
+					`Entry ${config.name}: failing ${depText}`,
 					vscode.DiagnosticSeverity.Warning);
 				diag.relatedInformation = [];
 
@@ -347,15 +429,15 @@ export class PropFile {
 				continue;
 			}
 
-			var selector = c.config.selector(ctx);
+			var selector = config.selector(ctx);
 			if (selector) {
 				diag = new vscode.Diagnostic(
 					line,
-					`Entry ${c.config.name} is ${c.value === "n" ? "ignored" : "redundant"} (Already selected by ${selector.name})`,
+					`Entry ${config.name} is ${c.value === "n" ? "ignored" : "redundant"} (Already selected by ${selector.name})`,
 					c.value === "n" ? vscode.DiagnosticSeverity.Warning : vscode.DiagnosticSeverity.Hint
 				);
 
-				var o = ctx.overrides.find(o => o.config.name === selector!.name);
+				var o = ctx.override(selector.name);
 				if (o && o.line !== undefined) {
 					diag.relatedInformation = [
 						new vscode.DiagnosticRelatedInformation(
@@ -374,16 +456,16 @@ export class PropFile {
 				continue;
 			}
 
-			var actualValue = c.config.evaluate(ctx);
+			var actualValue = config.evaluate(ctx);
 			if (override !== actualValue) {
 				diags.push(new vscode.Diagnostic(line,
-					`Entry ${c.config.name} assigned value ${c.value}, but evaluated to ${c.config.toValueString(actualValue)}`,
+					`Entry ${config.name} assigned value ${c.value}, but evaluated to ${config.toValueString(actualValue)}`,
 					vscode.DiagnosticSeverity.Warning));
 				continue;
 			}
 		}
 
-		console.log("Lint done.");
+		kEnv.debugLog("Lint done.");
 		this.lintDiags = diags;
 		this.actions = actions;
 		this.updateDiags();
@@ -400,25 +482,52 @@ export class PropFile {
 	}
 
 	onChange(e: vscode.TextDocumentChangeEvent) {
+		// Only changes that add or remove lines move the existing diagnostics:
 		var changes: {line: number, change: number}[] = [];
 		e.contentChanges.forEach(change => {
-			changes.push({
-				line: change.range.start.line,
-				change: change.range.start.line - change.range.end.line + (change.text.match(/\n/g) ?? []).length
-			});
+			var lineChange = change.range.start.line - change.range.end.line + (change.text.match(/\n/g) ?? []).length;
+			if (lineChange !== 0) {
+				changes.push({
+					line: change.range.start.line,
+					change: lineChange
+				});
+			}
 		});
 
-		this.lintDiags.forEach(diag => {
-			var diff = changes.reduce((sum, change, _) => (change.line <= diag.range.start.line ? sum + change.change : sum), 0);
+		if (changes.length > 0) {
+			// The published diagnostics must not change under the collection, so moved diagnostics are replaced:
+			var moved = new Map<vscode.Diagnostic, vscode.Diagnostic>();
+			this.lintDiags = this.lintDiags.map(diag => {
+				var diff = changes.reduce((sum, change, _) => (change.line <= diag.range.start.line ? sum + change.change : sum), 0);
+				if (diff === 0) {
+					return diag;
+				}
 
-			diag.range = new vscode.Range(
-				diag.range.start.line + diff,
-				diag.range.start.character,
-				diag.range.end.line + diff,
-				diag.range.end.character
-			);
-		});
-		this.parse(e.document.getText());
+				var newDiag = new vscode.Diagnostic(
+					new vscode.Range(
+						diag.range.start.line + diff,
+						diag.range.start.character,
+						diag.range.end.line + diff,
+						diag.range.end.character
+					),
+					diag.message,
+					diag.severity
+				);
+				newDiag.code = diag.code;
+				newDiag.source = diag.source;
+				newDiag.tags = diag.tags;
+				newDiag.relatedInformation = diag.relatedInformation;
+				moved.set(diag, newDiag);
+				return newDiag;
+			});
+
+			this.actions.forEach(action => {
+				action.diagnostics = action.diagnostics?.map(diag => moved.get(diag) ?? diag);
+			});
+		}
+		this.parseLines(kEnv.documentLines(e.document));
+		this.docVersion = e.document.version;
+		this.docRevision = this.repo.revision;
 		this.scheduleLint();
 	}
 
@@ -10,13 +10,11 @@ import * as yaml from 'yaml';
 import * as kEnv from './env';
 import * as glob from 'glob';
 import * as path from 'path';
-import { env } from 'process';
-import { countReset } from 'console';
 
-const MODULE_FILE = vscode.Uri.parse('kconfig://zephyr/binary.dir/Kconfig.modules');
-const SOC_FILE = vscode.Uri.parse('kconfig://zephyr/binary.dir/Kconfig.soc');
-const SOC_DEFCONFIG_FILE = vscode.Uri.parse('kconfig://zephyr/binary.dir/Kconfig.soc.defconfig');
-const SOC_ARCH_FILE = vscode.Uri.parse('kconfig://zephyr/binary.dir/Kconfig.soc.arch');
+const MODULE_FILE = vscode.Uri.parse('kconfig://zephyr/binary.dir/Kconfig.modules').toString();
+const SOC_FILE = vscode.Uri.parse('kconfig://zephyr/binary.dir/Kconfig.soc').toString();
+const SOC_DEFCONFIG_FILE = vscode.Uri.parse('kconfig://zephyr/binary.dir/Kconfig.soc.defconfig').toString();
+const SOC_ARCH_FILE = vscode.Uri.parse('kconfig://zephyr/binary.dir/Kconfig.soc.arch').toString();
 export var isZephyr: boolean;
 export var zephyrRoot: string | undefined;
 var westVersion: string;
@@ -43,7 +41,22 @@ function west(args: string[], callback?: (err: ExecException | null, stdout: str
 	return '';
 }
 
+// Running west and reading every module.yml is slow, so only do it once per scan:
+var kconfigRoots: string[] | undefined;
+
+export function invalidateKconfigRoots() {
+	kconfigRoots = undefined;
+}
+
 export function getKconfigRoots() {
+	if (!kconfigRoots) {
+		kconfigRoots = findKconfigRoots();
+	}
+
+	return kconfigRoots;
+}
+
+function findKconfigRoots() {
 	var modules = getModules();
 
 	return Object.values(modules)
@@ -164,16 +177,17 @@ function getKconfigSocRoots() {
 }
 
 function provideDoc(uri: vscode.Uri) {
-	if (uri.toString() === MODULE_FILE.toString()) {
+	var file = uri.toString();
+	if (file === MODULE_FILE) {
 		return getKconfigRoots().map(root => `osource "${root}"`).join('\n\n');
 	}
-	if (uri.toString() === SOC_DEFCONFIG_FILE.toString()) {
+	if (file === SOC_DEFCONFIG_FILE) {
 		return getKconfigSocRoots().map(root => `osource "${root}/soc/$(ARCH)/*/Kconfig.defconfig"`).join('\n');
 	}
-	if (uri.toString() === SOC_FILE.toString()) {
+	if (file === SOC_FILE) {
 		return getKconfigSocRoots().map(root => `osource "${root}/soc/$(ARCH)/*/Kconfig.soc"`).join('\n');
 	}
-	if (uri.toString() === SOC_ARCH_FILE.toString()) {
+	if (file === SOC_ARCH_FILE) {
 		return getKconfigSocRoots().map(root => `osource "${root}/soc/$(ARCH)/Kconfig"\nosource "${root}/soc/$(ARCH)/*/Kconfig"`).join('\n');
 	}
 	return '';
@@ -369,16 +383,19 @@ export async function activate(context: vscode.ExtensionContext): Promise<boolea
 	let run = async () => {
 
 		findWest();
+		kconfigRoots = undefined;
 
 		var hrTime = process.hrtime();
 		isZephyr = await checkIsZephyr();
 		if (isZephyr) {
 			activateZephyr(context);
 
-			hrTime = process.hrtime(hrTime);
+			if (kEnv.isDebugging()) {
+				hrTime = process.hrtime(hrTime);
 
-			var time_ms = Math.round(hrTime[0] * 1000 + hrTime[1] / 1000000);
-			console.log(`Zephyr activation: ${time_ms} ms`);
+				var time_ms = Math.round(hrTime[0] * 1000 + hrTime[1] / 1000000);
+				console.log(`Zephyr activation: ${time_ms} ms`);
+			}
 		} else if (zephyrRoot) {
 			vscode.window.showErrorMessage(`Kconfig: Couldn't find board`, 'Configure').then(e => {
 				if (e) {
@@ -421,7 +438,7 @@ export function onWestChange(context: vscode.ExtensionContext, westChange: () =>
 			}
 
 			var setupManifestWatcher = () => {
-				let lines = confDoc.getText().split(/\r?\n/);
+				let lines = kEnv.documentLines(confDoc);
 				var manifestIndex = lines.findIndex(l => l.includes('[manifest]'));
 				if (manifestIndex < 0 && manifestIndex >= lines.length - 1) {
 					return;
@@ -431,16 +448,23 @@ export function onWestChange(context: vscode.ExtensionContext, westChange: () =>
 				var westManifest = out.trim() + '/' + pathLine?.split('=')[1].trim() + '/west.yml';
 
 				vscode.workspace.openTextDocument(westManifest).then(doc => {
+					var manifestUri = doc.uri.toString();
 					context.subscriptions.push(vscode.workspace.onDidChangeTextDocument(e => {
-						if (e.document.uri.toString() === doc.uri.toString()) {
+						if (!e.document.isDirty && e.document.uri.toString() === manifestUri) {
+							kconfigRoots = undefined;
 							westChange();
 						}
 					}));
 				}, _ => {});
 			};
 
+			var confUri = confDoc.uri.toString();
+
+			// Rerunning west for every keystroke is expensive. Only react once the changes hit the disk,
+			// either through a save or an external change to the file:
 			context.subscriptions.push(vscode.workspace.onDidChangeTextDocument(e => {
-				if (e.document.uri.toString() === confDoc.uri.toString()) {
+				if (!e.document.isDirty && e.document.uri.toString() === confUri) {
+					kconfigRoots = undefined;
 					westChange();
 					setupManifestWatcher();
 				}